@@ -63,3 +63,30 @@ def ap_k(recommended_list, bought_list, k=5):
         [precision_at_k(recommended_list, bought_list, k=index_relevant + 1) for index_relevant in relevant_indexes])
     return sum_ / amount_relevant
 
+
+def _as_set(bought_list):
+    return bought_list if isinstance(bought_list, (set, frozenset)) else set(bought_list)
+
+
+def _hits_at_k(recommended_lists, bought_lists, k=5):
+    # bought_lists можно передать заранее построенными frozenset, чтобы не строить множества на каждый вызов
+    return np.fromiter((len(_as_set(bought_list).intersection(recommended_list[:k]))
+                        for recommended_list, bought_list in zip(recommended_lists, bought_lists)),
+                       dtype=np.float64, count=len(recommended_lists))
+
+
+def mean_precision_at_k(recommended_lists, bought_lists, k=5):
+    """precision@k, усредненная по юзерам (без построчного apply по датафрейму)"""
+    hits = _hits_at_k(recommended_lists, bought_lists, k=k)
+    n_recommended = np.fromiter((len(recommended_list[:k]) for recommended_list in recommended_lists),
+                                dtype=np.float64, count=len(recommended_lists))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.nanmean(hits / n_recommended)
+
+
+def mean_recall_at_k(recommended_lists, bought_lists, k=5):
+    """recall@k, усредненная по юзерам (без построчного apply по датафрейму)"""
+    hits = _hits_at_k(recommended_lists, bought_lists, k=k)
+    n_bought = np.fromiter((len(bought_list) for bought_list in bought_lists),
+                           dtype=np.float64, count=len(bought_lists))
+    return (hits / n_bought).mean()
@@ -1,15 +1,19 @@
+from functools import cached_property
+
 import pandas as pd
 import numpy as np
+from joblib import Parallel, delayed
 
 # Для работы с матрицами
-from scipy.sparse import csr_matrix, coo_matrix
+from scipy.sparse import coo_matrix
 
 # Матричная факторизация
 from implicit.als import AlternatingLeastSquares
 from implicit.bpr import BayesianPersonalizedRanking
+from implicit.gpu import HAS_CUDA
 from implicit.nearest_neighbours import ItemItemRecommender, CosineRecommender, TFIDFRecommender
 from implicit.nearest_neighbours import bm25_weight, tfidf_weight
-from src.metrics import recall_at_k, precision_at_k
+from src.metrics import mean_recall_at_k, mean_precision_at_k
 
 
 class MainRecommender:
@@ -17,7 +21,7 @@ class MainRecommender:
     def __init__(self, data: pd.DataFrame, weighting: str = 'bm25',
                  model_type: str = 'als', own_recommender_type: str = 'item-item',
                  recommender_params: dict = None, own_recommender_params: dict = None,
-                 user_item_matrix_values: str = 'binary'):
+                 user_item_matrix_values: str = 'binary', use_gpu: bool = False):
         """
         Input
         -----
@@ -36,72 +40,132 @@ class MainRecommender:
                                quantity. Если нет, то 0.
                 'purchase_sum': в случае, если пользователь взаимодействовал с товарот, то указывается значение признака
                                sales_value. Если нет, то 0.
+        use_gpu: обучать модель матричной факторизации на GPU (если implicit собран с CUDA).
+                 Имеет смысл на больших данных, где обучение дольше копирования матрицы на видеокарту
         """
 
-        # Топ покупок каждого юзера
-        self.top_purchases = data.groupby(['user_id', 'item_id'])['quantity'].count().reset_index()
-        self.top_purchases.sort_values('quantity', ascending=False, inplace=True)
-        self.top_purchases = self.top_purchases[self.top_purchases['item_id'] != 999999]
+        # Коды юзеров / товаров (id матрицы) считаем один раз - для топов покупок и для user-item матрицы
+        user_codes, item_codes, userids, itemids = self._factorize_ids(data)
 
-        # Топ покупок по всему датасету
-        self.overall_top_purchases = data.groupby('item_id')['quantity'].count().reset_index()
-        self.overall_top_purchases.sort_values('quantity', ascending=False, inplace=True)
-        self.overall_top_purchases = self.overall_top_purchases[self.overall_top_purchases['item_id'] != 999999]
-        self.overall_top_purchases = self.overall_top_purchases.item_id.tolist()
+        # Топ покупок каждого юзера (индекс user_id -> id товаров в матрице в порядке убывания числа покупок)
+        # и топ покупок по всему датасету (np.ndarray)
+        self._top_purchases_by_user, \
+            self.overall_top_purchases = self._prepare_top_purchases(user_codes, item_codes, userids, itemids)
+        self._no_purchases = np.empty(0, dtype=np.int64)  # топ покупок юзера, которого нет в данных
 
-        self.user_item_matrix = self._prepare_matrix(data, user_item_matrix_values)  # pd.DataFrame
+        self.user_item_matrix = self._prepare_matrix(data, user_item_matrix_values, user_codes, item_codes,
+                                                     shape=(len(userids), len(itemids)))  # csr_matrix
         self.id_to_itemid, self.id_to_userid, \
-            self.itemid_to_id, self.userid_to_id = self._prepare_dicts(self.user_item_matrix)
+            self.itemid_to_id, self.userid_to_id = self._prepare_dicts(userids, itemids)
+        self._next_user_idx = len(self.userid_to_id)  # id матрицы для следующего нового юзера
+        # Те же соответствия id матрицы -> исходный id в виде массивов, для векторного перевода результатов
+        self._id_to_itemid_arr = np.asarray(itemids)
+        # Только юзеры из обучающих данных: у новых юзеров нет факторов, и массив им не нужен
+        self._id_to_userid_arr = np.asarray(userids)
 
         # Взвешивание
-        if weighting == 'bm25':
-            self.user_item_matrix = bm25_weight(self.user_item_matrix.T).T
-        elif weighting == 'tfidf':
-            self.user_item_matrix = tfidf_weight(self.user_item_matrix.T).T
+        self._weight_matrix(self.user_item_matrix, weighting)
+
+        # CSR-матрицу строим один раз и переиспользуем при обучении и в каждом вызове recommend
+        self._user_items_csr = self.user_item_matrix
 
-        self.model = self.fit(self.user_item_matrix, model_type, recommender_params)
-        self.own_recommender = self.fit_own_recommender(self.user_item_matrix,
+        self.model = self.fit(self._user_items_csr, model_type, recommender_params, use_gpu=use_gpu)
+        self.own_recommender = self.fit_own_recommender(self._user_items_csr,
                                                         own_recommender_type,
                                                         own_recommender_params)
 
+        # Латентные факторы в виде numpy (у GPU-модели они хранятся на видеокарте) и нормы факторов товаров -
+        # для поиска похожих товаров матричным умножением (BLAS)
+        cpu_model = self.model.to_cpu() if hasattr(self.model, 'to_cpu') else self.model
+        self._user_factors = cpu_model.user_factors
+        self._item_factors = np.ascontiguousarray(cpu_model.item_factors, dtype=np.float32)
+        self._item_norms = np.linalg.norm(self._item_factors, axis=1) + 1e-8
+        # Самый похожий товар для каждого товара
+        self._top_similar = self._prepare_top_similar(self._item_factors, self._item_norms)
+
+    @staticmethod
+    def _factorize_ids(data: pd.DataFrame):
+        """
+        Кодирует user_id / item_id каждой строки data номерами строк / столбцов user-item матрицы.
+        Возвращает коды, а также user_id и item_id, соответствующие строкам и столбцам матрицы
+        """
+        # sort=True сохраняет порядок строк / столбцов, как у pd.pivot_table
+        user_codes, userids = pd.factorize(data['user_id'], sort=True)
+        item_codes, itemids = pd.factorize(data['item_id'], sort=True)
+        return user_codes, item_codes, np.asarray(userids), np.asarray(itemids)
+
     @staticmethod
-    def _prepare_matrix(data: pd.DataFrame, user_item_matrix_values: str):
-        """Готовит user-item матрицу"""
-        user_item_matrix = None
+    def _prepare_matrix(data: pd.DataFrame, user_item_matrix_values: str, user_codes, item_codes, shape):
+        """Готовит разреженную user-item матрицу (csr_matrix) без промежуточной плотной таблицы"""
 
+        values = None
         if user_item_matrix_values == 'binary':
-            user_item_matrix = pd.pivot_table(data,
-                                              index='user_id',
-                                              columns='item_id',
-                                              values='quantity',
-                                              aggfunc='count',
-                                              fill_value=0
-                                              )
+            values = np.ones(len(data), dtype=np.float32)
         elif user_item_matrix_values == 'quantity':
-            user_item_matrix = pd.pivot_table(data,
-                                              index='user_id',
-                                              columns='item_id',
-                                              values='quantity',
-                                              fill_value=0
-                                              )
+            values = data['quantity'].to_numpy(dtype=np.float32)
         elif user_item_matrix_values == 'purchase_sum':
-            user_item_matrix = pd.pivot_table(data,
-                                              index='user_id',
-                                              columns='item_id',
-                                              values='sales_value',
-                                              fill_value=0
-                                              )
+            values = data['sales_value'].to_numpy(dtype=np.float32)
+
+        # tocsr() суммирует повторяющиеся пары (user, item)
+        user_item_matrix = coo_matrix((values, (user_codes, item_codes)), shape=shape).tocsr()
 
-        user_item_matrix = user_item_matrix.astype(float)  # необходимый тип матрицы для implicit
+        if user_item_matrix_values != 'binary':
+            # Как и pd.pivot_table по умолчанию (aggfunc='mean'), усредняем значения по повторяющимся парам
+            counts = coo_matrix((np.ones(len(data), dtype=np.float32), (user_codes, item_codes)),
+                                shape=shape).tocsr()
+            user_item_matrix.data /= counts.data
+            # Пары с нулевым средним (quantity = 0, sales_value <= 0 при возвратах) не храним явными нулями:
+            # в pivot_table -> csr_matrix их не было, а bm25_weight / tfidf_weight учитывают хранимые элементы
+            user_item_matrix.eliminate_zeros()
 
         return user_item_matrix
 
     @staticmethod
-    def _prepare_dicts(user_item_matrix):
-        """Подготавливает вспомогательные словари"""
+    def _weight_matrix(user_item_matrix, weighting: str):
+        """
+        Взвешивает user-item матрицу (csr_matrix) на месте.
+        Веса считаются в item-user ориентации: user_item_matrix.T - это view (CSC) без копии, а COO-матрица,
+        которую возвращают bm25_weight / tfidf_weight, хранит значения в том же порядке, что и исходная CSR.
+        Поэтому подменяем только массив значений - без транспонирований и пересборки CSR
+        """
+        weighted = None
+        if weighting == 'bm25':
+            weighted = bm25_weight(user_item_matrix.T)
+        elif weighting == 'tfidf':
+            weighted = tfidf_weight(user_item_matrix.T)
 
-        userids = user_item_matrix.index.values
-        itemids = user_item_matrix.columns.values
+        if weighted is not None:
+            # Веса приходят во float64 - приводим обратно к float32, с которым работает implicit
+            user_item_matrix.data = weighted.data.astype(np.float32)
+
+    @staticmethod
+    def _prepare_top_purchases(user_codes, item_codes, userids, itemids):
+        """
+        Считает кол-во покупок каждой пары (user, item) и каждого товара без groupby:
+        пара кодируется одним int64, частоты пар - через np.unique, частоты товаров - через np.bincount.
+        Фиктивный товар 999999 в топы не попадает
+        """
+        n_items = len(itemids)
+
+        pair_keys, pair_counts = np.unique(user_codes.astype(np.int64) * n_items + item_codes, return_counts=True)
+        pair_users, pair_items = np.divmod(pair_keys, n_items)
+        not_fake = itemids[pair_items] != 999999
+        pair_users, pair_items, pair_counts = pair_users[not_fake], pair_items[not_fake], pair_counts[not_fake]
+
+        # Пары, отсортированные по юзеру, а внутри юзера - по убыванию кол-ва покупок
+        order = np.lexsort((-pair_counts, pair_users))
+        unique_users, user_starts = np.unique(pair_users[order], return_index=True)
+        top_purchases_by_user = dict(zip(userids[unique_users], np.split(pair_items[order], user_starts[1:])))
+
+        item_counts = np.bincount(item_codes, minlength=n_items)
+        overall_top_purchases = itemids[np.argsort(-item_counts, kind='stable')]
+        overall_top_purchases = overall_top_purchases[overall_top_purchases != 999999]
+
+        return top_purchases_by_user, overall_top_purchases
+
+    @staticmethod
+    def _prepare_dicts(userids, itemids):
+        """Подготавливает вспомогательные словари"""
 
         matrix_userids = np.arange(len(userids))
         matrix_itemids = np.arange(len(itemids))
@@ -115,9 +179,10 @@ class MainRecommender:
         return id_to_itemid, id_to_userid, itemid_to_id, userid_to_id
 
     @staticmethod
-    def fit_own_recommender(user_item_matrix, own_recommender_type, params):
+    def fit_own_recommender(user_items, own_recommender_type, params):
         """
         Обучает модель, которая рекомендует товары, среди товаров, купленных юзером
+        user_items: user-item матрица в формате csr_matrix
         Параметры для рекомендательной модели передаются в виде словаря
         """
 
@@ -133,111 +198,194 @@ class MainRecommender:
         elif own_recommender_type == 'tfidf':
             own_recommender = TFIDFRecommender(**params)
 
-        own_recommender.fit(csr_matrix(user_item_matrix).T.tocsr(), show_progress=False)
+        # nearest_neighbours модели implicit работают только с float64
+        own_recommender.fit(user_items.astype(np.float64), show_progress=False)
         return own_recommender
 
     @staticmethod
-    def fit(user_item_matrix, model_type, params=None):
+    def fit(user_items, model_type, params=None, use_gpu=False):
         """
         Обучает модель
+        user_items: user-item матрица в формате csr_matrix
         Параметры для рекомендательной модели передаются в виде словаря
+        use_gpu: обучать на GPU, если он доступен (явно заданный в params 'use_gpu' имеет приоритет)
         """
 
         model = None
         if params is None:
             params = {'factors': 20, 'regularization': 0.001, 'iterations': 15, 'num_threads': 4, 'random_state': 0}
+        params = {'use_gpu': use_gpu and HAS_CUDA, **params}
 
         if model_type == 'als':
             model = AlternatingLeastSquares(**params)
-            model.fit(csr_matrix(user_item_matrix).T.tocsr(), show_progress=False)
+            model.fit(user_items, show_progress=False)
         elif model_type == 'bpr':
             model = BayesianPersonalizedRanking(**params)
-            model.fit(csr_matrix(user_item_matrix).T.tocsr(), show_progress=False)
+            model.fit(user_items, show_progress=False)
 
         return model
 
+    @staticmethod
+    def _prepare_top_similar(item_factors, item_norms, block_size_bytes=32 * 2 ** 20):
+        """
+        Находит для каждого товара самый похожий на него товар (по id матрицы) по косинусной мере.
+        Сходство считается блоками товаров: одно матричное умножение на блок, результат пишется
+        в один и тот же буфер размером не больше block_size_bytes
+        """
+        normed_factors = item_factors / item_norms[:, np.newaxis]
+        n_items = normed_factors.shape[0]
+        top_similar = np.empty(n_items, dtype=np.int64)
+
+        batch_size = min(n_items, max(1, block_size_bytes // (normed_factors.itemsize * n_items)))
+        scores_buffer = np.empty((batch_size, n_items), dtype=normed_factors.dtype)
+
+        for start in range(0, n_items, batch_size):
+            stop = min(start + batch_size, n_items)
+            scores = scores_buffer[:stop - start]
+            np.matmul(normed_factors[start:stop], normed_factors.T, out=scores)
+            scores[np.arange(stop - start), np.arange(start, stop)] = -np.inf  # Сам товар не рекомендуем
+            top_similar[start:stop] = scores.argmax(axis=1)
+
+        return top_similar
+
+    @staticmethod
+    def _factors_to_df(factors, ids, id_col_name, factor_prefix):
+        """Собирает датафрейм [id_col_name, factor_prefix_0, ...] из матрицы факторов без pd.concat"""
+        factors_df = pd.DataFrame(factors, columns=[f'{factor_prefix}_{i}' for i in range(factors.shape[1])])
+        factors_df.insert(0, id_col_name, ids)
+        return factors_df
+
+    @cached_property
+    def _item_factors_df(self):
+        n_items = self._item_factors.shape[0]
+        return self._factors_to_df(self._item_factors, self._id_to_itemid_arr[:n_items], 'item_id', 'item_factor')
+
+    @cached_property
+    def _user_factors_df(self):
+        return self._factors_to_df(self._user_factors, self._id_to_userid_arr, 'user_id', 'user_factor')
+
     def get_item_factors(self):
-        """Возвращает латентные факторы товаров, расчитанные моделью матричной факторизации"""
-        item_factors = pd.DataFrame(self.model.item_factors)
-        item_factors.columns = [f'item_factor_{i}' for i in range(len(item_factors.columns))]
-        item_ids = [self.id_to_itemid[itm_id] for itm_id in range(item_factors.shape[0])]
-        item_factors = pd.concat([pd.DataFrame(item_ids), item_factors], axis=1)
-        item_factors.rename(columns={0: 'item_id'}, inplace=True)
-        return item_factors
+        """
+        Возвращает латентные факторы товаров, расчитанные моделью матричной факторизации.
+        Датафрейм строится один раз и переиспользуется в следующих вызовах - не изменяйте его на месте
+        """
+        return self._item_factors_df
 
     def get_user_factors(self):
-        """Возвращает латентные факторы пользователей, расчитанные моделью матричной факторизации"""
-        user_factors = pd.DataFrame(self.model.user_factors)
-        user_factors.columns = [f'user_factor_{i}' for i in range(len(user_factors.columns))]
-        user_ids = [self.id_to_userid[usr_id] for usr_id in range(user_factors.shape[0])]
-        user_factors = pd.concat([pd.DataFrame(user_ids), user_factors], axis=1)
-        user_factors.rename(columns={0: 'user_id'}, inplace=True)
-        return user_factors
+        """
+        Возвращает латентные факторы пользователей, расчитанные моделью матричной факторизации.
+        Датафрейм строится один раз и переиспользуется в следующих вызовах - не изменяйте его на месте
+        """
+        return self._user_factors_df
 
     def _update_dict(self, user_id):
         """Если появился новый user / item, то нужно обновить словари"""
 
-        if user_id not in self.userid_to_id.keys():
-            max_id = max(list(self.userid_to_id.values()))
-            max_id += 1
-
-            self.userid_to_id.update({user_id: max_id})
-            self.id_to_userid.update({max_id: user_id})
+        if user_id not in self.userid_to_id:
+            self.userid_to_id[user_id] = self._next_user_idx
+            self.id_to_userid[self._next_user_idx] = user_id
+            self._next_user_idx += 1
 
     def _get_similar_item(self, item_id):
         """Находит товар, похожий на item_id"""
-        recs = self.model.similar_items(self.itemid_to_id[item_id], N=2)  # Товар похож на себя -> рекомендуем 2 товара
-        top_rec = recs[1][0]  # И берем второй (не товар из аргумента метода)
-        return self.id_to_itemid[top_rec]
+        return self._id_to_itemid_arr[self._top_similar[self.itemid_to_id[item_id]]]
 
     def _extend_with_top_popular(self, recommendations, N=5):
         """Если кол-во рекоммендаций < N, то дополняем их топ-популярными"""
 
-        if len(recommendations) < N:
-            recommendations.extend(self.overall_top_purchases[:N])
-            recommendations = recommendations[:N]
+        n_missing = N - len(recommendations)
+        if n_missing > 0:
+            # Берем только недостающие товары, не изменяя переданный список
+            recommendations = recommendations + self.overall_top_purchases[:n_missing].tolist()
 
+        # Единая проверка для всех методов рекомендаций, отключается при запуске с python -O
+        assert len(recommendations) == N, 'Количество рекомендаций != {}'.format(N)
         return recommendations
 
+    def _is_known_user(self, user_id):
+        """Есть ли у юзера (id матрицы или массив id) строка в user-item матрице"""
+        return np.asarray(user_id) < self._user_items_csr.shape[0]
+
     def _get_recommendations(self, user, model, N=5):
         """Рекомендации через стардартные библиотеки implicit"""
 
         self._update_dict(user_id=user)
 
-        res = [self.id_to_itemid[rec[0]] for rec in model.recommend(userid=self.userid_to_id[user],
-                                                                    user_items=csr_matrix(
-                                                                        self.user_item_matrix).tocsr(),
-                                                                    N=N,
-                                                                    filter_already_liked_items=False,
-                                                                    filter_items=[self.itemid_to_id[999999]],
-                                                                    recalculate_user=False)]
+        user_id = self.userid_to_id[user]
+        if not self._is_known_user(user_id):
+            # Новый юзер (добавлен в _update_dict): ни факторов, ни покупок в матрице -> топ-популярные
+            return self._extend_with_top_popular([], N=N)
 
-        res = self._extend_with_top_popular(res, N=N)
+        # В recommend передаем только строку юзера, а не всю матрицу
+        ids, _ = model.recommend(userid=user_id,
+                                 user_items=self._user_items_csr[user_id],
+                                 N=N,
+                                 filter_already_liked_items=False,
+                                 filter_items=[self.itemid_to_id[999999]],
+                                 recalculate_user=False)
+        res = self._id_to_itemid_arr[ids[:N]].tolist()
 
-        assert len(res) == N, 'Количество рекомендаций != {}'.format(N)
+        res = self._extend_with_top_popular(res, N=N)
         return res
 
+    def _get_recommendations_batch(self, users, model, N=5):
+        """Рекомендации сразу для списка юзеров одним батчевым вызовом implicit"""
+
+        for user in users:
+            self._update_dict(user_id=user)
+
+        user_ids = np.fromiter((self.userid_to_id[user] for user in users), dtype=np.int64, count=len(users))
+        return self._get_recommendations_by_ids(user_ids, model=model, N=N)
+
+    def _get_recommendations_by_ids(self, user_ids, model, N=5):
+        """Батчевые рекомендации для массива id юзеров в матрице (без перевода user_id -> id)"""
+
+        result = [[] for _ in range(len(user_ids))]  # новым юзерам останутся только топ-популярные
+
+        known = self._is_known_user(user_ids)
+        if known.any():
+            ids, _ = model.recommend(userid=user_ids[known],
+                                     user_items=self._user_items_csr[user_ids[known]],
+                                     N=N,
+                                     filter_already_liked_items=False,
+                                     filter_items=[self.itemid_to_id[999999]],
+                                     recalculate_user=False)
+
+            for pos, user_recs in zip(np.flatnonzero(known), ids):
+                # implicit дополняет строку до N значением -1, если рекомендаций меньше N
+                result[pos] = self._id_to_itemid_arr[user_recs[user_recs >= 0]].tolist()
+
+        return [self._extend_with_top_popular(res, N=N) for res in result]
+
     def get_recommendations(self, user, N=5):
         """Рекомендации через стардартные библиотеки implicit"""
 
         self._update_dict(user_id=user)
         return self._get_recommendations(user, model=self.model, N=N)
 
+    def get_recommendations_batch(self, users, N=5):
+        """Рекомендации через стардартные библиотеки implicit для списка юзеров"""
+
+        return self._get_recommendations_batch(list(users), model=self.model, N=N)
+
     def get_own_recommendations(self, user, N=5):
         """Рекомендуем товары среди тех, которые юзер уже купил"""
 
         self._update_dict(user_id=user)
         return self._get_recommendations(user, model=self.own_recommender, N=N)
 
+    def get_own_recommendations_batch(self, users, N=5):
+        """Рекомендуем товары среди тех, которые юзер уже купил, для списка юзеров"""
+
+        return self._get_recommendations_batch(list(users), model=self.own_recommender, N=N)
+
     def get_similar_items_recommendation(self, user_id, N=5):
         """Рекомендуем товары, похожие на топ-N купленных юзером товаров"""
 
-        top_users_purchases = self.top_purchases[self.top_purchases['user_id'] == user_id].head(N)
+        top_ids = self._top_purchases_by_user.get(user_id, self._no_purchases)[:N]
 
-        res = top_users_purchases['item_id'].apply(lambda x: self._get_similar_item(x)).tolist()
+        res = self._id_to_itemid_arr[self._top_similar[top_ids]].tolist()
         res = self._extend_with_top_popular(res, N=N)
-
-        assert len(res) == N, 'Количество рекомендаций != {}'.format(N)
         return res
 
     def get_similar_users_recommendation(self, user_id, N=5):
@@ -245,46 +393,59 @@ class MainRecommender:
 
         res = []
 
+        # Для нового юзера похожих не найти -> топ-популярные
+        user_idx = self.userid_to_id.get(user_id)
+        if user_idx is None or not self._is_known_user(user_idx):
+            return self._extend_with_top_popular(res, N=N)
+
         # Находим топ-N похожих пользователей
-        similar_users = self.model.similar_users(self.userid_to_id[user_id], N=N + 1)
-        similar_users = [self.id_to_userid[rec[0]] for rec in similar_users]
-        similar_users = similar_users[1:]  # удалим юзера из запроса
+        ids, _ = self.model.similar_users(user_idx, N=N + 1)
+        similar_users = ids[1:]  # удалим юзера из запроса
 
-        for _user_id in similar_users:
-            res.extend(self.get_own_recommendations(_user_id, N=1))
+        # По 1 товару от каждого похожего юзера - одним батчевым вызовом own_recommender
+        for user_recs in self._get_recommendations_by_ids(similar_users, model=self.own_recommender, N=1):
+            res.extend(user_recs)
 
         res = self._extend_with_top_popular(res, N=N)
-
-        assert len(res) == N, 'Количество рекомендаций != {}'.format(N)
         return res
 
     @staticmethod
     def _get_result(df_result):
         result_eval = df_result.groupby('user_id')['item_id'].unique().reset_index()
         result_eval.columns = ['user_id', 'actual']
+        # Множества купленных товаров строим один раз для всех вызовов метрик
+        result_eval['actual_set'] = result_eval['actual'].map(frozenset)
         return result_eval
 
+    @staticmethod
+    def _apply_per_user(func, users, N, n_jobs=1):
+        """Вызывает func(user, N=N) для каждого юзера; при n_jobs != 1 - параллельно в потоках"""
+        if n_jobs == 1:
+            return [func(user, N=N) for user in users]
+        return Parallel(n_jobs=n_jobs, prefer='threads')(delayed(func)(user, N=N) for user in users)
+
     def _get_recommend_eval(self, result_eval, target_col_name, result_col_name,
-                            recommend_model_type, N_PREDICT):
+                            recommend_model_type, N_PREDICT, n_jobs=1):
 
         if recommend_model_type == 'own':
-            result_eval[result_col_name] = result_eval[target_col_name].apply(
-                lambda x: self.get_own_recommendations(x, N=N_PREDICT))
+            result_eval[result_col_name] = self.get_own_recommendations_batch(result_eval[target_col_name],
+                                                                              N=N_PREDICT)
         elif recommend_model_type == 'rec':
-            result_eval[result_col_name] = result_eval[target_col_name].apply(
-                lambda x: self.get_recommendations(x, N=N_PREDICT))
+            result_eval[result_col_name] = self.get_recommendations_batch(result_eval[target_col_name],
+                                                                          N=N_PREDICT)
         elif recommend_model_type == 'itm':
-            result_eval[result_col_name] = result_eval[target_col_name].apply(
-                lambda x: self.get_similar_items_recommendation(x, N=N_PREDICT))
+            # Без потоков: здесь только выборки из словаря и массивов под GIL, потоки лишь добавят накладные расходы
+            result_eval[result_col_name] = [self.get_similar_items_recommendation(user_id, N=N_PREDICT)
+                                            for user_id in result_eval[target_col_name]]
         elif recommend_model_type == 'usr':
-            result_eval[result_col_name] = result_eval[target_col_name].apply(
-                lambda x: self.get_similar_users_recommendation(x, N=N_PREDICT))
+            result_eval[result_col_name] = self._apply_per_user(self.get_similar_users_recommendation,
+                                                                result_eval[target_col_name], N_PREDICT, n_jobs)
         else:
             return
 
         return result_eval
 
-    def evalMetrics(self, metric_type, df_result, target_col_name, recommend_model_type, N_PREDICT):
+    def evalMetrics(self, metric_type, df_result, target_col_name, recommend_model_type, N_PREDICT, n_jobs=1):
         """
         Возвращает значение метрики качества модели
         metric_type: 'recall' or 'precision'
@@ -295,28 +456,32 @@ class MainRecommender:
             'itm': self.get_similar_items_recommendation
             'usr': self.get_similar_users_recommendation
         N_PREDICT: коэффициент 'K'
+        n_jobs: кол-во потоков для рекомендаций 'usr' (-1 - все ядра). Остальные типы n_jobs не используют:
+                'own' и 'rec' считаются одним батчевым вызовом, 'itm' - табличными выборками без вызовов модели
         """
 
         result_eval = self._get_result(df_result)
         result_col_name = 'result_' + recommend_model_type
 
         result_eval = self._get_recommend_eval(result_eval, target_col_name, result_col_name,
-                                               recommend_model_type, N_PREDICT)
+                                               recommend_model_type, N_PREDICT, n_jobs)
 
         if metric_type == 'recall':
-            return result_eval.apply(lambda row: recall_at_k(row[result_col_name], row['actual'], k=N_PREDICT),
-                                     axis=1).mean()
+            return mean_recall_at_k(result_eval[result_col_name].to_numpy(),
+                                    result_eval['actual_set'].to_numpy(), k=N_PREDICT)
         elif metric_type == 'precision':
-            return result_eval.apply(lambda row: precision_at_k(row[result_col_name], row['actual'],
-                                                                k=N_PREDICT), axis=1).mean()
+            return mean_precision_at_k(result_eval[result_col_name].to_numpy(),
+                                       result_eval['actual_set'].to_numpy(), k=N_PREDICT)
 
     @staticmethod
-    def _rerank(user_id, df_predict, target_col_name):
-        return df_predict[df_predict[target_col_name] == user_id].sort_values('proba_item_purchase',
-                                                                              ascending=False).head(5).item_id.tolist()
+    def _rerank(df_predict, target_col_name):
+        """Возвращает словарь user_id -> топ-5 товаров по убыванию скора (одна сортировка на всех юзеров)"""
+        df_sorted = df_predict.sort_values([target_col_name, 'proba_item_purchase'], ascending=[True, False])
+        df_top = df_sorted.groupby(target_col_name, sort=False).head(5)
+        return df_top.groupby(target_col_name, sort=False)['item_id'].agg(list).to_dict()
 
     def reranked_metrics(self, metric_type, df_result, df_predict,
-                         target_col_name, recommend_model_type, N_PREDICT, return_reranked_data=True):
+                         target_col_name, recommend_model_type, N_PREDICT, return_reranked_data=True, n_jobs=1):
 
         """
         Возвращает значение метрики модели ранжирования
@@ -330,24 +495,26 @@ class MainRecommender:
             'usr': self.get_similar_users_recommendation
         N_PREDICT: коэффициент 'K'
         return_reranked_data: Если 'True', помимо значения метрики возвращает датафрейм с переранжированными данными
+        n_jobs: кол-во потоков для рекомендаций 'usr' (-1 - все ядра). Остальные типы n_jobs не используют:
+                'own' и 'rec' считаются одним батчевым вызовом, 'itm' - табличными выборками без вызовов модели
         """
         result_eval = self._get_result(df_result)
         result_col_name = 'result_' + recommend_model_type
         reranked_col_name = 'reranked_' + recommend_model_type + '_rec'
 
         result_eval = self._get_recommend_eval(result_eval, target_col_name, result_col_name,
-                                               recommend_model_type, N_PREDICT)
+                                               recommend_model_type, N_PREDICT, n_jobs)
 
-        result_eval[reranked_col_name] = result_eval[target_col_name].apply(
-            lambda user_id: self._rerank(user_id, df_predict, target_col_name))
+        reranked = self._rerank(df_predict, target_col_name)
+        result_eval[reranked_col_name] = result_eval[target_col_name].map(lambda user_id: reranked.get(user_id, []))
 
         metric_result = None
         if metric_type == 'recall':
-            metric_result = result_eval.apply(lambda row: recall_at_k(row[reranked_col_name], row['actual'],
-                                                                      k=N_PREDICT), axis=1).mean()
+            metric_result = mean_recall_at_k(result_eval[reranked_col_name].to_numpy(),
+                                             result_eval['actual_set'].to_numpy(), k=N_PREDICT)
         elif metric_type == 'precision':
-            metric_result = result_eval.apply(lambda row: precision_at_k(row[reranked_col_name], row['actual'],
-                                                                         k=N_PREDICT), axis=1).mean()
+            metric_result = mean_precision_at_k(result_eval[reranked_col_name].to_numpy(),
+                                                result_eval['actual_set'].to_numpy(), k=N_PREDICT)
         if return_reranked_data:
             return metric_result, result_eval[['user_id', reranked_col_name]]
         else: